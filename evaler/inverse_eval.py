@@ -4,21 +4,33 @@ Functions for evaluating and visualizing M/EEG source estimates.
 Author: John GW Samuelsson. 
 """
 
+import importlib.util
+import pickle
+from collections import namedtuple
+from itertools import islice
+
 import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import cdist
 #from mayavi import mlab
 from multiprocessing import Pool
+from joblib import Parallel, delayed
+try:
+    from numba import njit, prange
+    _has_numba = True
+except ImportError:
+    _has_numba = False
 
 import mne
 from mne.minimum_norm import read_inverse_operator, prepare_inverse_operator
 from mne.minimum_norm.inverse import _assemble_kernel
 from mne.io import RawArray
 
-from .source_space_tools import remove_overlap_in_labels, blurring
+from .source_space_tools import remove_overlap_in_labels, blurring, join_source_spaces, print_ply
 from .mne_simulation import get_raw_noise
 from .settings import settings_class
 from .plotting_tools import plot_topographic_parcellation
 
-
 def setup_labels(subject, parc, subjects_dir, unwanted_labels=['unknown', 'corpuscallosum']):
     """Returns a list of labels from parcellation, removing unwanted labels.
 
@@ -96,28 +108,7 @@ def setup(subjects_dir, subject, data_path, fname_raw, fname_fwd,
     fwd = mne.convert_forward_solution(fwd, surf_ori=True, force_fixed=True)
 
     # Remove sources in unwanted labels (corpus callosum and unknown)
-    sources_to_remove = np.array([])
-    offset = fwd['src'][0]['nuse']
-    vertnos_lh = fwd['src'][0]['vertno']
-    vertnos_rh = fwd['src'][1]['vertno']
-    for label in labels_unwanted:
-        vertnos = label.vertices
-        
-        # Find vertices to remove from the gain matrix
-        if label.hemi == 'lh':
-            sources_to_remove = np.concatenate((sources_to_remove, np.where(np.in1d(vertnos_lh, vertnos))[0]))
-            src_ind= 0
-        if label.hemi == 'rh':
-            sources_to_remove = np.concatenate((sources_to_remove, np.where(np.in1d(vertnos_rh, vertnos))[0] + offset))
-            src_ind = 1
-            
-        # Correct src info
-        fwd['src'][src_ind]['inuse'][vertnos] = 0
-        fwd['src'][src_ind]['nuse'] = np.sum(fwd['src'][src_ind]['inuse'])
-        fwd['src'][src_ind]['vertno'] = np.nonzero(fwd['src'][src_ind]['inuse'])[0]   
-    source_to_keep = np.where(~np.in1d(range(fwd['sol']['data'].shape[1]), sources_to_remove.astype(int)))[0]
-    fwd['sol']['data'] = fwd['sol']['data'][:,source_to_keep]
-    fwd['nsource'] = fwd['src'][0]['nuse'] + fwd['src'][1]['nuse']
+    fwd = correct_fwd(fwd, labels_unwanted)
     
     # Plot labels
     if plot_labels:
@@ -164,7 +155,97 @@ def _getInversionKernel(inverse_operator, nave=1, lambda2=1. / 9., method='MNE',
     return K
 
 
-def _convert_real_resolution_matrix_to_labels(R, labels, label_verts):
+def _membership_matrix(index_lists, n_cols):
+    """Builds a sparse membership matrix from a list of index arrays.
+
+    Parameters
+    ----------
+    index_lists : list
+        List of arrays, each containing the column indicies of one group
+        (e.g. the vertex indicies of a label).
+    n_cols : int
+        Number of columns of the membership matrix.
+
+    Returns
+    -------
+    M : sparse matrix, shape (n_groups, n_cols)
+        CSR matrix where M[g, i] is 1 if index i belongs to group g and 0
+        otherwise.
+    counts : array, shape (n_groups)
+        Number of indicies in each group.
+    """
+    counts = np.array([len(inds) for inds in index_lists], dtype=int)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    if indptr[-1] > 0:
+        indices = np.concatenate(index_lists).astype(int)
+    else:
+        indices = np.array([], dtype=int)
+    M = sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                          shape=(len(index_lists), n_cols))
+    return M, counts
+
+
+if _has_numba:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _group_R_numba(R, verts_flat, offsets):
+        """Numba kernel of _convert_real_resolution_matrix_to_labels. Label a 
+        holds vertex indicies verts_flat[offsets[a]:offsets[a+1]]."""
+        n_labels = len(offsets) - 1
+        R_label = np.zeros((n_labels, n_labels))
+        for a in prange(n_labels):
+            for b in range(n_labels):
+                n_b = offsets[b+1] - offsets[b]
+                if n_b == 0:
+                    R_label[b, a] = np.nan
+                    continue
+                s = 0.0
+                for j in range(offsets[b], offsets[b+1]):
+                    acc = 0.0
+                    for i in range(offsets[a], offsets[a+1]):
+                        acc += R[verts_flat[j], verts_flat[i]]
+                    s += abs(acc)
+                R_label[b, a] = s / n_b
+        return R_label
+
+
+_LabelIndex = namedtuple('_LabelIndex', ['verts', 'offsets', 'hemi', 'sizes', 'M'])
+
+
+def _build_label_index(labels, src):
+    """Flattens the vertices of all labels into one index array over the
+    vertices of both hemispheres, where right hemisphere vertices are offset
+    by the number of vertices in the left hemisphere.
+
+    Parameters
+    ----------
+    labels : list
+        List of labels.
+    src : list
+        List of surface source space objects.
+
+    Returns
+    -------
+    label_index : namedtuple
+        With fields verts (concatenated vertex indicies of all labels),
+        offsets (start of each label in verts, followed by len(verts)), hemi
+        (0 for left and 1 for right hemisphere labels), sizes (number of
+        vertices in each label) and M (sparse membership matrix of shape
+        (n_labels, n_vertices), see _membership_matrix).
+    """
+    hemi = np.array([int(label.hemi == 'rh') for label in labels], dtype=int)
+    n_lh = src[0]['np']
+    M, sizes = _membership_matrix([label.vertices + n_lh*h for label, h in zip(labels, hemi)],
+                                  n_lh + src[1]['np'])
+    return _LabelIndex(M.indices, M.indptr, hemi, sizes, M)
+
+
+def _get_source_mask(src):
+    """Returns a boolean array over the vertices of both hemispheres that is
+    True for vertices in use as sources."""
+    return np.concatenate([lookup >= 0 for lookup in _get_vertno_lookup(src)])
+
+
+def _convert_real_resolution_matrix_to_labels(R, labels, label_verts, use_numba=False):
     """Converts a point-source resolution matrix to a patch-source resolution
     matrix based on labels by summing all rows in the point-source matrix 
     corresponding to sources in each label, mimicking simultaneous activation 
@@ -181,6 +262,10 @@ def _convert_real_resolution_matrix_to_labels(R, labels, label_verts):
     label_verts : dictionary
         Dictionary containing label names as keys and their vertix indicies as 
         values.
+    use_numba : Boolean
+        If True and numba is installed, use the numba kernel instead of the
+        sparse matrix products. Only faster for small R or without a BLAS 
+        backed sparse multiply.
 
     Returns
     -------
@@ -188,14 +273,64 @@ def _convert_real_resolution_matrix_to_labels(R, labels, label_verts):
         The patch-source resolution matrix. 
 
     """
-    R_label = np.zeros((len(labels),len(labels)))
-    for a, label in enumerate(labels):
-        for b, label_r in enumerate(labels):
-            R_label[b,a] = np.mean(np.abs(np.sum(R[:,label_verts[label.name]],axis=1)[label_verts[label_r.name]]))
-#            R_label[b,a] = np.mean(np.sum(R[label_verts[label_r.name],:][:,label_verts[label.name]], axis=1))
+    index_lists = [label_verts[label.name] for label in labels]
+    if use_numba and _has_numba:
+        counts = np.array([len(inds) for inds in index_lists], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        verts_flat = np.concatenate(index_lists + [np.array([], dtype=np.int64)]).astype(np.int64)
+        return _group_R_numba(np.ascontiguousarray(R), verts_flat, offsets)
+    M, counts = _membership_matrix(index_lists, R.shape[1])
+    # Simultaneous activation of all sources in each label, shape (n_vertices, n_labels)
+    patch_estimates = M.dot(R.T).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R_label = M.dot(np.abs(patch_estimates)) / counts[:, np.newaxis]
     return R_label 
 
 
+def _get_analytical_R_gpu(K, G, M, counts, block_size=1024):
+    """Computes the analytical point-source resolution matrix R = K @ G and
+    groups it into labels (see _convert_real_resolution_matrix_to_labels) on 
+    the GPU with CuPy.
+
+    Parameters
+    ----------
+    K : array, shape (n_vertices, n_channels)
+        Inverse kernel.
+    G : array, shape (n_channels, n_vertices)
+        Gain matrix.
+    M : sparse matrix, shape (n_labels, n_vertices)
+        Label membership matrix.
+    counts : array, shape (n_labels)
+        Number of sources in each label.
+    block_size : int
+        Number of rows of R that are upcast to double precision at a time
+        when grouping into labels.
+
+    Returns
+    -------
+    R_label : array, shape (n_labels, n_labels) 
+        The patch-source resolution matrix. 
+    R : array, shape (n_vertices, n_vertices)
+        Absolute value of the point-source resolution matrix, in single precision.
+    """
+    import cupy as cp
+    import cupyx.scipy.sparse
+
+    R = cp.dot(cp.asarray(K, dtype=cp.float32), cp.asarray(G, dtype=cp.float32))
+    M = cupyx.scipy.sparse.csr_matrix(M)
+    # Group into labels in double precision, as the sparse products on the CPU do,
+    # upcasting only one block of rows of R at a time
+    patch_estimates = cp.empty((R.shape[0], M.shape[0]), dtype=cp.float64)
+    for start in range(0, R.shape[0], block_size):
+        stop = start + block_size
+        patch_estimates[start:stop] = M.dot(R[start:stop].T.astype(cp.float64)).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R_label = M.dot(cp.abs(patch_estimates)).get() / counts[:, np.newaxis]
+    del patch_estimates, M
+    R = cp.abs(R, out=R).get()
+    return R_label, R
+
+
 def standardize_columns(R, arg):
     """Standardizes matrix R with respect to the maximal value in each column 
     or its diagonal value.
@@ -216,13 +351,10 @@ def standardize_columns(R, arg):
     """
     if arg not in ['diag','max']:
         raise ValueError('arg must be either "diag" or "max". Breaking.')
-    R_std = R.copy()
-    for d in range(len(R_std.T)):
-        if arg == 'diag':
-            diag = R_std[d,d]
-            R_std[:,d] = R_std[:,d]/diag
-        if arg == 'max':
-            R_std[:,d] = R_std[:,d]/np.max(R_std[:,d])
+    if arg == 'diag':
+        R_std = R / np.diag(R)[np.newaxis, :]
+    if arg == 'max':
+        R_std = R / np.max(R, axis=0, keepdims=True)
     return R_std
 
 
@@ -260,11 +392,13 @@ def get_empirical_R_large(data_path, subjects, inv_methods, SNRs, waveform, inv_
     Get empirical resolution matrix for large simulations (splits up inverse
     methods in different runs)
     """
+    from .inverse_evaler import get_empirical_R
     
     nested_inv_methods = [[inv_method] for inv_method in inv_methods]
     for inv_methods_n in nested_inv_methods:
-        R_emp = evaler.get_empirical_R(data_path, subjects, inv_methods_n, SNRs, waveform, inv_function, len(SNRs))
-        pickle.dump(R_emp, open('./R_emp_'+inv_methods[0],'wb'))
+        R_emp = get_empirical_R(data_path, subjects, inv_methods_n, SNRs, waveform, inv_function, len(SNRs))
+        with open('./R_emp_'+inv_methods_n[0], 'wb') as f:
+            pickle.dump(R_emp, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     return 
 
@@ -283,35 +417,107 @@ def load_R_emp(inv_methods):
         Loaded empirical resolution matrix containing data for all inverse methods.
     """
 
-    R_emp = pickle.load(open('./R_emp_'+inv_methods[0],'rb'))
     R_emp_all = {}
-    for subj in list(R_emp.keys()):
-        R_emp_all.update({subj : {}})
-        for stats in list(R_emp[subj].keys()):
-            R_emp_all[subj].update({stats : {}})
-            if stats in ['r_master', 'r_master_point_patch']:
-                for inv_method in inv_methods:
-                    R_emp_all[subj][stats].update({inv_method : []})
-            else:
-                for sub_stats in list(R_emp[subj][stats].keys())[0:2]:
-                    R_emp_all[subj][stats].update({sub_stats : {}})
-                    for inv_method in inv_methods:
-                        R_emp_all[subj][stats][sub_stats].update({inv_method : []})
-    
     for inv_method in inv_methods:
-        R_emp = pickle.load(open('./R_emp_'+inv_method,'rb'))
-        for subj in list(R_emp.keys()):
-            for stats in list(R_emp[subj].keys()):
+        with open('./R_emp_'+inv_method, 'rb') as f:
+            R_emp = pickle.load(f)
+        for subj, R_emp_subj in R_emp.items():
+            R_emp_all_subj = R_emp_all.setdefault(subj, {})
+            for stats, R_emp_stats in R_emp_subj.items():
                 if stats in ['r_master', 'r_master_point_patch']:
-                    R_emp_all[subj][stats][inv_method] = R_emp[subj][stats][inv_method]
+                    R_emp_all_subj.setdefault(stats, {})[inv_method] = R_emp_stats[inv_method]
                 else:
-                    for sub_stats in list(R_emp[subj][stats].keys())[0:2]:
-                        R_emp_all[subj][stats][sub_stats][inv_method] = R_emp[subj][stats][sub_stats][inv_method]
-    R_emp_all[list(R_emp_all.keys())[0]]['r_master'].update({'SNRs' : SNRs})
+                    for sub_stats in islice(R_emp_stats.keys(), 2):
+                        R_emp_all_subj.setdefault(stats, {}).setdefault(sub_stats, {})[inv_method] = \
+                            R_emp_stats[sub_stats][inv_method]
+    first_subj = next(iter(R_emp_all))
+    R_emp_all[first_subj]['r_master'].update({'SNRs' : R_emp[first_subj]['r_master']['SNRs']})
     
     return R_emp_all
 
 
+def _get_vertno_lookup(src):
+    """Returns lookup tables from vertex numbers to source indicies.
+
+    Parameters
+    ----------
+    src : list
+        List of surface source space objects.
+
+    Returns
+    -------
+    vertno_lookup : list
+        List with one array per hemisphere of length src[hemi]['np'], holding
+        the index in src[hemi]['vertno'] of each vertex, or -1 if the vertex is
+        not a source.
+    """
+    vertno_lookup = []
+    for hemi_src in src:
+        lookup = np.full(hemi_src['np'], -1, dtype=int)
+        lookup[hemi_src['vertno']] = np.arange(len(hemi_src['vertno']))
+        vertno_lookup.append(lookup)
+    return vertno_lookup
+
+
+def _get_source_inds(lookup, vertices):
+    """Returns the source indicies of the vertices that are in use as sources.
+
+    Parameters
+    ----------
+    lookup : array
+        Lookup table of one hemisphere, as returned by _get_vertno_lookup.
+    vertices : array
+        Vertex numbers, e.g. the vertices of a label.
+
+    Returns
+    -------
+    inds : array
+        Indicies in vertno of the vertices that are sources.
+    """
+    inds = lookup[vertices]
+    return inds[inds >= 0]
+
+
+def _build_label_verts(src, labels):
+    """Returns the source indicies of each label and the corresponding
+    membership matrix.
+
+    Parameters
+    ----------
+    src : list
+        List of surface source space objects.
+    labels : list
+        List of labels.
+
+    Returns
+    -------
+    label_verts : dictionary
+        Dictionary containing label names as keys and their source indicies as 
+        values.
+    M : sparse matrix, shape (n_labels, n_sources)
+        Membership matrix of the labels (see _membership_matrix).
+    counts : array, shape (n_labels)
+        Number of sources in each label.
+    """
+    import warnings
+    label_verts = {}
+    vertno_lookup = _get_vertno_lookup(src)
+    for label in labels:
+        if label.hemi == 'lh':
+            hemi_ind = 0
+            vert_offset = 0
+        if label.hemi == 'rh':
+            hemi_ind = 1     
+            vert_offset = src[0]['nuse']
+        inds = _get_source_inds(vertno_lookup[hemi_ind], label.vertices)+vert_offset
+        if len(inds) == 0:
+            warnings.warn(label.name + ' label has no active source.')
+        label_verts.update({label.name : inds})
+    M, counts = _membership_matrix([label_verts[label.name] for label in labels],
+                                   src[0]['nuse'] + src[1]['nuse'])
+    return label_verts, M, counts
+
+
 def correct_fwd(fwd, labels_unwanted):
     """Corrects a forward object by removing the parts of the gain matrix 
     corresponding to sources in labels_unwanted.
@@ -327,33 +533,139 @@ def correct_fwd(fwd, labels_unwanted):
     fwd : instance of Forward
         The corrected forward object.
     """
-    sources_to_remove = np.array([])
+    source_to_keep = np.ones(fwd['sol']['data'].shape[1], dtype=bool)
     offset = fwd['src'][0]['nuse']
-    vertnos_lh = fwd['src'][0]['vertno']
-    vertnos_rh = fwd['src'][1]['vertno']
+    lookup_lh, lookup_rh = _get_vertno_lookup(fwd['src'])
     for label in labels_unwanted:
         vertnos = label.vertices
         
         # Find vertices to remove from the gain matrix
         if label.hemi == 'lh':
-            sources_to_remove = np.concatenate((sources_to_remove, np.where(np.in1d(vertnos_lh, vertnos))[0]))
+            source_to_keep[_get_source_inds(lookup_lh, vertnos)] = False
             src_ind= 0
         if label.hemi == 'rh':
-            sources_to_remove = np.concatenate((sources_to_remove, np.where(np.in1d(vertnos_rh, vertnos))[0] + offset))
+            source_to_keep[_get_source_inds(lookup_rh, vertnos) + offset] = False
             src_ind = 1
             
         # Correct src info
         fwd['src'][src_ind]['inuse'][vertnos] = 0
         fwd['src'][src_ind]['nuse'] = np.sum(fwd['src'][src_ind]['inuse'])
         fwd['src'][src_ind]['vertno'] = np.nonzero(fwd['src'][src_ind]['inuse'])[0]   
-    source_to_keep = np.where(~np.in1d(range(fwd['sol']['data'].shape[1]), sources_to_remove.astype(int)))[0]
     fwd['sol']['data'] = fwd['sol']['data'][:,source_to_keep]
     fwd['nsource'] = fwd['sol']['data'].shape[1]
     
     return fwd
  
 
-def get_R(inp):
+def _get_activation_estimate(G_sum_label, act, scaling, noise, goodies, evoked_template, fwd, noise_cov,
+                             invmethod, inv_function, SNR, inverse_operator, M_labels, label_counts, progress):
+    """Simulates patch activation of one label and estimates the resulting
+    source activity. Helper for get_R.
+
+    Parameters
+    ----------
+    G_sum_label : array, shape (n_good_channels, 1)
+        Summed gain of all sources in the activated label for the good channels.
+    act : array, shape (1, n_times)
+        Activation waveform scaled to source amplitude.
+    scaling : float
+        Amplitude scaling of the simulated signal. If inf, no noise is added.
+    noise : array, shape (n_good_channels, n_times)
+        Background activity to be superposed with the simulated signal.
+    goodies : array
+        Indicies of the good channels.
+    evoked_template : instance of Evoked
+        Evoked object with the average EEG reference projector and NaN in the
+        rows of bad channels. A copy of it, with the good channel rows set to
+        the simulated data, is passed to the inverse method.
+    fwd : instance of Forward
+    noise_cov : instance of Covariance
+    invmethod : string
+        Inverse method to test.
+    inv_function : function handle
+        User-defined function that returns the estimate.
+    SNR : float
+        SNR in sensor space of the estimation.
+    inverse_operator : instance of InverseOperator | None
+    M_labels : sparse matrix, shape (n_labels, n_vertices)
+        Label membership matrix.
+    label_counts : array, shape (n_labels)
+        Number of sources in each label.
+    progress : string
+        Progress message to print.
+
+    Returns
+    -------
+    R_emp_col : array, shape (n_labels)
+        Column of the empirical resolution matrix for the activated label.
+    R_label_vert_col : array, shape (n_vertices)
+        Column of the empirical resolution matrix where estimates are not
+        grouped into labels.
+    """
+    # Patch activation equals the summed gain of the label times the waveform
+    signal = np.dot(G_sum_label, act)
+
+    """
+    Find average empirical SNR and invert to get average scaled SNR of grads, mags and EEG right. 
+    Note that we take the average of the absolute value of the resolution matricx at each time point in order 
+    to avoid problems with baseline correction. Therefore we should not scale the SNR with respect to the number 
+    of time points in the waveform. If calculating time-averaged resolution matrix for constant activation function, 
+    also scale SNR with respect to number of time points.
+    """
+### Fixed SNR scaling for each activation starts here
+#    empirical_SNR = 0
+#    for key in list(mod_ind.keys()):
+#        signal_strength = np.mean(np.linalg.norm(signal[mod_ind[key], :], axis=1))
+#        empirical_SNR = empirical_SNR + 1. / 3. * signal_strength / noise_power[key]
+#    scaling = SNR / empirical_SNR
+### Fixed scaling ends here
+    if scaling == np.inf:
+        sens = signal
+    else:
+        sens = scaling * signal + noise 
+    
+    # Copy the prepared template so that inverse functions may modify the evoked
+    evoked = evoked_template.copy()
+    evoked._data[goodies, :] = sens
+
+    if invmethod == 'mixed_norm':
+        estimate = mne.inverse_sparse.mixed_norm(evoked, fwd, noise_cov, alpha = 55, 
+                                                    loose = 0, verbose='WARNING')
+        lh_verts = estimate.vertices[0]
+        rh_verts = estimate.vertices[1]
+        vertno_lookup = _get_vertno_lookup(fwd['src'])
+        src_inds = np.concatenate((_get_source_inds(vertno_lookup[0], lh_verts),
+                                   _get_source_inds(vertno_lookup[1], rh_verts)+fwd['src'][0]['nuse']))
+        R_label_vert_col = np.zeros(M_labels.shape[1])
+        R_label_vert_col[src_inds] = np.mean(np.abs(estimate.data), axis=1)
+
+        # Let resolution matrix of the entry be the mean over the active dipoles in the label over all time chunks
+        active = np.zeros(M_labels.shape[1])
+        active[src_inds] = 1.
+        dipoles_in_label = M_labels.dot(active)
+        R_emp_col = np.divide(M_labels.dot(R_label_vert_col), dipoles_in_label,
+                              out=np.zeros(M_labels.shape[0]), where=dipoles_in_label > 0)
+        if np.sum(R_emp_col) == 0.:
+            break_point
+            raise Exception('Estimate was equal to zero. Aborting.')
+    else:
+
+        # Inv_function is a user specified inverse method that maps evoked -> array (n_labels x n_labels)
+        source = inv_function(evoked, SNR, invmethod, inverse_operator)
+        if np.sum(np.isnan(source))>0:
+            break_point
+            raise Exception('Nan value found in source estimate. Aborting.')
+        # Resolution matrix without summing of patch vertices, resulting in shape (n_vertices, n_labels)
+        R_label_vert_col = np.mean(np.abs(source), axis=1)
+        # Each entry is the average of all dipole amplitudes in the patch over time
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R_emp_col = M_labels.dot(R_label_vert_col) / label_counts
+        
+    print(progress, end='\r', flush=True)
+    return R_emp_col, R_label_vert_col
+
+
+def get_R(inp, n_jobs=1, use_gpu=False, use_numba=False, inverse_operator=None):
     """Calculates empirical and/or analytical resolution matrix.
 
     Parameters
@@ -361,8 +673,10 @@ def get_R(inp):
     inp : tuple containing the following parameters;
         waveform : array
             Activation waveform; time signal of label activation amplitude.
-        fname_fwd : string
-            Path to forward object.
+        fname_fwd : string | instance of Forward
+            Path to forward object, or forward object with fixed orientations
+            from which the sources in labels_unwanted already have been removed
+            (see correct_fwd).
         labels : list
             List containing parcellation labels.
         invmethod : string
@@ -384,11 +698,25 @@ def get_R(inp):
         inv_function : function handle
             User-defined function that returns the estimate. See documentation in
             for_manuscript.py.
-        cov_fname : string
-            Path to noise covariance. Will be used in creating the inverse operator.
-        ave_fname : string
-            Path to average Evoked object, will act as background activity to be
-            superposed with simulated signal.
+        cov_fname : string | instance of Covariance
+            Path to noise covariance, or the noise covariance. Will be used in 
+            creating the inverse operator.
+        ave_fname : string | instance of Evoked
+            Path to average Evoked object, or the Evoked object. Will act as 
+            background activity to be superposed with simulated signal.
+    n_jobs : int
+        Number of jobs to run in parallel over the activation labels.
+    use_gpu : Boolean
+        If True, the analytical resolution matrix is computed on the GPU with
+        CuPy. Falls back to the CPU if CuPy is not installed.
+    use_numba : Boolean
+        If True, the analytical resolution matrix is grouped into labels with 
+        a numba kernel instead of sparse matrix products (see 
+        _convert_real_resolution_matrix_to_labels). Ignored if numba is not
+        installed.
+    inverse_operator : instance of InverseOperator | None
+        Inverse operator made from the forward solution, noise covariance and
+        info of ave_fname. If None, it is made here when invmethod is linear.
 
     Returns
     -------
@@ -398,7 +726,8 @@ def get_R(inp):
         R_analytical : array, shape (n_labels, n_labels)
             Analytical resolution matrix grouped together in labels.
         R : array, shape (n_vertices, n_vertices)
-            Analytical resolution matrix for point sources.
+            Absolute value of the analytical resolution matrix for point
+            sources, in single precision.
     If compute_analytical is False:
         R_emp : array, shape (n_labels, n_activation_labels)
             Empirical resolution matrix.
@@ -410,11 +739,20 @@ def get_R(inp):
     waveform, fname_fwd, labels, invmethod, labels_unwanted, SNR, \
         activation_labels, compute_analytical, inv_function, cov_fname, ave_fname  = inp
 
-    epochs_ave = mne.read_evokeds(ave_fname)[0]
-    noise_cov = mne.read_cov(cov_fname)
-    fwd = mne.read_forward_solution(fname_fwd)
-    fwd = mne.convert_forward_solution(fwd, surf_ori=True, force_fixed=True)
-    fwd = correct_fwd(fwd, labels_unwanted)
+    if isinstance(ave_fname, str):
+        epochs_ave = mne.read_evokeds(ave_fname)[0]
+    else:
+        epochs_ave = ave_fname
+    if isinstance(cov_fname, str):
+        noise_cov = mne.read_cov(cov_fname)
+    else:
+        noise_cov = cov_fname
+    if isinstance(fname_fwd, str):
+        fwd = mne.read_forward_solution(fname_fwd)
+        fwd = mne.convert_forward_solution(fwd, surf_ori=True, force_fixed=True)
+        fwd = correct_fwd(fwd, labels_unwanted)
+    else:
+        fwd = fname_fwd
 
     if activation_labels == None:
         activation_labels=labels
@@ -424,19 +762,7 @@ def get_R(inp):
         SNR = np.inf
     
     # Create a dictionary linking labels with its vertices
-    label_verts = {}
-    for label in labels:
-        if label.hemi == 'lh':
-            hemi_ind = 0
-            vert_offset = 0
-        if label.hemi == 'rh':
-            hemi_ind = 1     
-            vert_offset = fwd['src'][0]['nuse']
-        verts_in_src_space = label.vertices[np.isin(label.vertices,fwd['src'][hemi_ind]['vertno'])]
-        inds = np.where(np.in1d(fwd['src'][hemi_ind]['vertno'],verts_in_src_space))[0]+vert_offset
-        if len(inds) == 0:
-            warnings.warn(label.name + ' label has no active source.')
-        label_verts.update({label.name : inds})
+    label_verts, M_labels, label_counts = _build_label_verts(fwd['src'], labels)
         
 ############## Noise from epochs
     goodies = np.array([c for c, ch in enumerate(epochs_ave.info['ch_names']) if not ch in epochs_ave.info['bads']])
@@ -456,100 +782,48 @@ def get_R(inp):
     noise = noise[goodies, :]
     
     # Create inverse operator if applied inverse method is linear
-    if invmethod in ['MNE', 'dSPM', 'eLORETA', 'sLORETA']:
+    if inverse_operator is None and invmethod in ['MNE', 'dSPM', 'eLORETA', 'sLORETA']:
         
         inverse_operator = mne.minimum_norm.make_inverse_operator(epochs_ave.info, fwd, noise_cov, depth=None, fixed=True)
-    else:
+    elif invmethod not in ['MNE', 'dSPM', 'eLORETA', 'sLORETA']:
         inverse_operator = None
 
+    # Summed gain of all sources in each activation label, shape (n_channels, n_activation_labels)
+    M_act = _membership_matrix([label_verts[label.name] for label in activation_labels],
+                               fwd['sol']['data'].shape[1])[0]
+    G_sum = M_act.dot(fwd['sol']['data'].T).T
+
     # Find activated source amplitude scaling by setting averge SNR to constant
     sign_pow = {}
     for key in list(mod_ind.keys()):
-        signal_powers = []
-        for c,label in enumerate(activation_labels):
-            inds = label_verts[label.name]
-            G = fwd['sol']['data'][:, :][:, inds]*10**-8
-            signal = np.sum(G, axis=1)
-            signal_power = np.mean(np.abs(signal[mod_ind[key]])*np.sqrt(waveform.shape[1]))
-            signal_powers.append(signal_power)
+        signal_powers = np.mean(np.abs(G_sum[mod_ind[key], :]*10**-8)*np.sqrt(waveform.shape[1]), axis=0)
         sign_pow.update({key : np.mean(signal_powers)})
     snrs = [sign_pow[key] / noise_power[key] for key in list(mod_ind.keys())]
     ave_scale = SNR / np.mean(snrs)
 
 
-    # Patch activation of each label
-    for c,label in enumerate(activation_labels):
-        inds = label_verts[label.name]
-        G = fwd['sol']['data'][:, inds]
-        act = np.repeat(waveform, repeats=len(inds), axis=0)*10**-8
-        signal = np.dot(G,act)
-
-        """
-        Find average empirical SNR and invert to get average scaled SNR of grads, mags and EEG right. 
-        Note that we take the average of the absolute value of the resolution matricx at each time point in order 
-        to avoid problems with baseline correction. Therefore we should not scale the SNR with respect to the number 
-        of time points in the waveform. If calculating time-averaged resolution matrix for constant activation function, 
-        also scale SNR with respect to number of time points.
-        """
-### Fixed SNR scaling for each activation starts here
-#        empirical_SNR = 0
-#        for key in list(mod_ind.keys()):
-#            signal_strength = np.mean(np.linalg.norm(signal[mod_ind[key], :], axis=1))
-#            empirical_SNR = empirical_SNR + 1. / 3. * signal_strength / noise_power[key]
-#        scaling = SNR / empirical_SNR
-### Fixed scaling ends here
-        signal = signal[goodies, :]
-        scaling = ave_scale
-        if scaling == np.inf:
-            sens = signal
-            lambda2 = 1./9.
-        else:
-            sens = scaling * signal + noise 
-        
-        evoked = epochs_ave.copy()
-        evoked.data = sens
-        evoked.set_eeg_reference('average', projection=True, verbose='WARNING')
-        # Need to put evoked into format with bad channels for inverse modeling
-        evoked_mod = evoked.copy()
-        evoked_mod._data = np.zeros((len(evoked.ch_names), evoked._data.shape[1]))
-        evoked_mod._data[:] = np.nan
-        evoked_mod._data[goodies, :] = evoked._data
-        evoked = evoked_mod
-
-        if invmethod == 'mixed_norm':
-            estimate = mne.inverse_sparse.mixed_norm(evoked, fwd, noise_cov, alpha = 55, 
-                                                        loose = 0, verbose='WARNING')
-            lh_verts = estimate.vertices[0]
-            rh_verts = estimate.vertices[1]
-            src_inds = np.where(np.in1d(fwd['src'][0]['vertno'],lh_verts))[0]
-            src_inds = np.concatenate((src_inds, np.where(np.in1d(fwd['src'][1]['vertno'],rh_verts))[0]+fwd['src'][0]['nuse']))
-            
-            for d,label_r in enumerate(labels):
-                inds_r = label_verts[label_r.name]
-                dipoles_in_label = np.where(np.isin(src_inds, inds_r))[0]
-                # Let resolution matrix of the entry be the mean of that entry over all time chunks
-                if dipoles_in_label.shape[0] > 0:
-                    R_emp[d,c] = np.mean(np.abs(estimate.data[dipoles_in_label,:]))
-            R_label_vert[src_inds,c] = np.mean(np.abs(estimate.data), axis=1)
-            if np.sum(R_emp[:,c]) == 0.:
-                break_point
-                raise Exception('Estimate was equal to zero. Aborting.')
-        else:
+    if ave_scale == np.inf:
+        lambda2 = 1./9.
 
-            # Inv_function is a user specified inverse method that maps evoked -> array (n_labels x n_labels)
-            source = inv_function(evoked, SNR, invmethod, inverse_operator)
-            if np.sum(np.isnan(source))>0:
-                break_point
-                raise Exception('Nan value found in source estimate. Aborting.')
-            # Loop through each label and populate entries in resolution matrix with the mean of the absolute over time.       
-            for d,label_r in enumerate(labels):
-                inds_r = label_verts[label_r.name]
-                # Each entry is the average of all dipole amplitudes in the patch over time
-                R_emp[d,c] = np.mean(np.abs(source[inds_r,:]))
-            # Resolution matrix without summing of patch vertices, resulting in shape (n_vertices, n_labels)
-            R_label_vert[:,c] = np.mean(np.abs(source), axis=1)
-            
-        print(labels[0].subject + ', ' + invmethod + ': ' + str(c/len(activation_labels) * 100) + ' %... ', end='\r', flush=True)
+    # Gain restricted to good channels and source amplitude are the same for all activations
+    G_sum_goodies = G_sum[goodies, :]
+    act = waveform*10**-8
+
+    # Need to put evoked into format with bad channels for inverse modeling. The
+    # reference projector and bad channel rows are the same for all activations.
+    evoked_template = epochs_ave.copy()
+    evoked_template.set_eeg_reference('average', projection=True, verbose='WARNING')
+    evoked_template._data = np.full((len(evoked_template.ch_names), waveform.shape[1]), np.nan)
+
+    # Patch activation of each label
+    out = Parallel(n_jobs=n_jobs)(delayed(_get_activation_estimate)(
+              G_sum_goodies[:, c:c+1], act, ave_scale, noise, goodies, evoked_template, fwd, noise_cov,
+              invmethod, inv_function, SNR, inverse_operator, M_labels, label_counts,
+              labels[0].subject + ', ' + invmethod + ': ' + str(c/len(activation_labels) * 100) + ' %... ')
+              for c in range(len(activation_labels)))
+    for c, (R_emp_col, R_label_vert_col) in enumerate(out):
+        R_emp[:,c] = R_emp_col
+        R_label_vert[:,c] = R_label_vert_col
     print('\n done.')
 
     if compute_analytical:
@@ -563,9 +837,16 @@ def get_R(inp):
         else:
             print('Resolution matrix on closed form is only available for linear methods; MNE, dSPM and sLORETA. Returning only empirical...')
             return R_emp
-        R = np.dot(K, fwd['sol']['data'][goodies, :])
-        R_analytical = _convert_real_resolution_matrix_to_labels(R, labels, label_verts)
-        return R_emp, R_analytical, np.abs(R)
+        if use_gpu and importlib.util.find_spec('cupy') is None:
+            warnings.warn('CuPy is not installed, computing analytical resolution matrix on CPU.')
+            use_gpu = False
+        if use_gpu:
+            R_analytical, R = _get_analytical_R_gpu(K, fwd['sol']['data'][goodies, :], M_labels, label_counts)
+            return R_emp, R_analytical, R
+        # Single precision is sufficient for the magnitudes and label sums of R and halves its memory traffic
+        R = np.dot(K.astype(np.float32), fwd['sol']['data'][goodies, :].astype(np.float32))
+        R_analytical = _convert_real_resolution_matrix_to_labels(R, labels, label_verts, use_numba)
+        return R_emp, R_analytical, np.abs(R, out=R)
     
     else:
         return (np.abs(R_emp), R_label_vert)
@@ -576,10 +857,8 @@ def remove_diagonal(A):
     Removes diagonal from matrix A.
     """
     
-    A_off_diagonal = A.copy()
-    np.fill_diagonal(A_off_diagonal, 9999999999999999)
-    bool_ind = A_off_diagonal.T==9999999999999999
-    return A_off_diagonal.T[np.where(~bool_ind)].reshape(A_off_diagonal.shape[1], A_off_diagonal.shape[0]-1).T  
+    off_diagonal = ~np.eye(A.shape[1], A.shape[0], dtype=bool)
+    return A.T[off_diagonal].reshape(A.shape[1], A.shape[0]-1).T  
 
 
 def get_average_cross_talk_map(R):
@@ -640,23 +919,11 @@ def get_spatial_dispersion(R, src, labels):
     """
     rr = np.concatenate((src[0]['rr'][src[0]['vertno']],
                          src[1]['rr'][src[1]['vertno']]), axis=0)
-    peak_positons = rr[np.argmax(np.abs(R), axis=0), :]
-#    #Hauk
-#    dist = np.linalg.norm(np.repeat(rr.reshape(1, len(rr), 3), repeats=rr.shape[0], axis=0)
-#                          - np.repeat(rr.reshape(rr.shape[0], 1, 3), repeats=len(rr), axis=1), axis=2)
-#    SD_hauk = np.sqrt(np.divide(np.diag(np.dot(dist.T, R**2)), np.sum(R**2, axis=0)))*10
-#    #Molins
-#    dist = np.linalg.norm(np.repeat(rr.reshape(1, len(rr), 3), repeats=rr.shape[0], axis=0)
-#                          - np.repeat(rr.reshape(rr.shape[0], 1, 3), repeats=len(rr), axis=1), axis=2)
-#    SD_molins = np.sqrt(np.divide(np.diag(np.dot(dist.T**2, R**2)), np.sum(R**2, axis=0)))*100    
-    #Samuelsson
-    dist = np.linalg.norm(np.repeat(peak_positons.reshape(1, len(peak_positons), 3), repeats=R.shape[0], axis=0)
-                          - np.repeat(rr.reshape(rr.shape[0], 1, 3), repeats=len(peak_positons), axis=1), axis=2)
-    SD = np.divide(np.diag(np.dot(dist.T, R)), np.sum(np.abs(R), axis=0))*100
-#    r_dist = np.linalg.norm(np.repeat(rr.reshape((rr.shape[0], rr.shape[1], 1)), repeats=peak_positons.shape[0], axis=2) - \
-#                       np.repeat(peak_positons.reshape((peak_positons.shape[0], peak_positons.shape[1], 1)), repeats=rr.shape[0], axis=2).T, axis=1)
-#    mean_dist = np.mean(r_dist, axis=0)
-#    SD = np.divide(SD, mean_dist)
+    R_abs = np.abs(R)
+    peak_positons = rr[np.argmax(R_abs, axis=0), :]
+    # Distance from every source to the peak of each activation, shape (n_vertices, n_sources)
+    dist = cdist(rr, peak_positons)
+    SD = np.divide(np.einsum('ij,ij->j', dist, R), np.sum(R_abs, axis=0))*100
     return SD
     
 
@@ -697,23 +964,19 @@ def get_spherical_coge(R, settings, labels):
         # Get hemispherical resolution matrix and label centers
         R_hemi = R[source_ind_hemi[c],:][:, source_ind_hemi[c]]
         labels_hemi = labels_divide[c]
-        label_center = []
-        for label in labels_hemi:
-            verts = label[1].vertices
-            label_center.append(np.mean(rr[verts,:],axis=0))
-        label_center = np.array(label_center)             
-
-        # Calculate center of gravity and error on spherical surface
-        for c, col in enumerate(R_hemi.T):
-            center_of_gravity = np.dot(col, label_center)/np.sum(col)
-            center_of_gravity = center_of_gravity*radius/np.linalg.norm(center_of_gravity)
-            error = np.linalg.norm(label_center[c] - center_of_gravity)
-            surface_error = 2 * radius * np.arcsin(error / (2 * radius))
-            spherical_coge['cog_vector_norm'].append(np.linalg.norm(center_of_gravity) / radius)
-            spherical_coge['coge'].append(surface_error)
+        M, counts = _membership_matrix([label[1].vertices for label in labels_hemi], rr.shape[0])
+        label_center = M.dot(rr) / counts[:, np.newaxis]
+
+        # Calculate center of gravity of all columns and error on spherical surface
+        center_of_gravity = np.dot(R_hemi.T, label_center)/np.sum(R_hemi, axis=0)[:, np.newaxis]
+        center_of_gravity = center_of_gravity*radius/np.linalg.norm(center_of_gravity, axis=1, keepdims=True)
+        error = np.linalg.norm(label_center - center_of_gravity, axis=1)
+        surface_error = 2 * radius * np.arcsin(error / (2 * radius))
+        spherical_coge['cog_vector_norm'].append(np.linalg.norm(center_of_gravity, axis=1) / radius)
+        spherical_coge['coge'].append(surface_error)
             
-    spherical_coge['cog_vector_norm'] = np.array(spherical_coge['cog_vector_norm'])
-    spherical_coge['coge'] = 100*np.array(spherical_coge['coge'])    
+    spherical_coge['cog_vector_norm'] = np.concatenate(spherical_coge['cog_vector_norm'])
+    spherical_coge['coge'] = 100*np.concatenate(spherical_coge['coge'])    
     return spherical_coge
 
 def get_label_center_points(labels, src, src_space_sphere):
@@ -737,36 +1000,35 @@ def get_label_center_points(labels, src, src_space_sphere):
     center_vertices : array, shape (n_sources)
         Indicies of center vertices.
     """
-    labels_divide = [[(c, label) for c, label in enumerate(labels) if label.hemi=='lh'],
-                 [(c, label) for c, label in enumerate(labels) if label.hemi=='rh']]
-    
-    center_points = []
-    center_vertices = []
-    zero_labels = []
-    for c, hemi in enumerate(['lh', 'rh']):
-        src_sphere = src_space_sphere[c]
-        
-        # Get vertices, move center of sphere to origo
-        rr = src_sphere['rr'] - np.mean(src_sphere['rr'], axis=0)
-        
-        # Get hemispherical resolution matrix and label centers
-        labels_hemi = labels_divide[c]
-        for label in labels_hemi:
-            label_verts = label[1].vertices
-            label_center = np.mean(rr[label_verts,:],axis=0)
-            sources_in_label = np.array([vert for vert in label[1].vertices if vert in src[c]['vertno']])
-            if len(sources_in_label) == 0:
-                zero_labels.append(label)
-            else:
-                center_vertex = sources_in_label[np.argmin(np.linalg.norm(label_center-rr[sources_in_label, :], axis=1))]
-                center_vertices.append(center_vertex + c*src[0]['np'])
+    label_index = _build_label_index(labels, src)
+    # Left hemisphere labels come first in the returned arrays
+    hemi_order = np.argsort(label_index.hemi, kind='stable')
+
+    # Get vertices of both hemispheres, move center of each sphere to origo
+    rr = np.concatenate([src_sphere['rr'] - np.mean(src_sphere['rr'], axis=0) 
+                         for src_sphere in src_space_sphere], axis=0)
+
+    # Get the sources in each label
+    is_source = _get_source_mask(src)[label_index.verts]
+    n_sources = np.diff(np.concatenate(([0], np.cumsum(is_source)))[label_index.offsets])
+    zero_labels = [(c, labels[c]) for c in hemi_order if n_sources[c] == 0]
 
     print('zero labels:')
     print(zero_labels)
 
+    # No center vertices are needed if any label lacks sources
     if len(zero_labels) > 0:
         return np.zeros((1000,3)), np.zeros((1000,3))
-    center_vertices = np.array(center_vertices)
+
+    label_centers = label_index.M.dot(rr) / label_index.sizes[:, np.newaxis]
+
+    # Closest source to the center within each label; lexsort is stable so ties resolve as in argmin
+    sources = label_index.verts[is_source]
+    label_ind = np.repeat(np.arange(len(labels)), label_index.sizes)[is_source]
+    dist = np.linalg.norm(rr[sources, :] - label_centers[label_ind, :], axis=1)
+    order = np.lexsort((dist, label_ind))
+    first = np.concatenate(([0], np.cumsum(n_sources)[:-1])).astype(int)
+    center_vertices = sources[order[first]][hemi_order]
     center_points = np.concatenate((src[0]['rr'], src[1]['rr']), axis=0)[center_vertices, :]
     
     return center_points, center_vertices 
@@ -820,16 +1082,9 @@ def get_label_center(labels, src):
     label_center : array, shape (n_labels, 3)
         The center of gravity of each label.
     """
-    label_center = []
-
-    for label in labels:
-        verts = label.vertices
-        if label.hemi=='lh':
-            label_center.append(np.mean(src[0]['rr'][verts,:],axis=0))
-        if label.hemi=='rh':
-            label_center.append(np.mean(src[1]['rr'][verts,:],axis=0))
-        
-    label_center = np.array(label_center)
+    rr = np.concatenate((src[0]['rr'], src[1]['rr']), axis=0)
+    label_index = _build_label_index(labels, src)
+    label_center = label_index.M.dot(rr) / label_index.sizes[:, np.newaxis]
     
     return label_center
 
@@ -857,22 +1112,19 @@ def get_center_of_gravity_error(R, src, labels):
         
     """
     label_center = get_label_center(labels, src)            
-    coge = []
-    center_of_gravity_list = []
-    cog_closest_source = []
-
-    for c, col in enumerate(R.T):
-        center_of_gravity = np.dot(col, label_center)/np.sum(col)
-        error = np.linalg.norm(label_center[c] - center_of_gravity)
-        coge.append(error)
-        center_of_gravity_list.append(center_of_gravity)
-        cog_closest_source.append(np.argmin(np.linalg.norm(np.repeat(center_of_gravity.reshape((1,3)),
-                                                                     len(labels),axis=0)-label_center, axis=1)))
+
+    # Centers of gravity of all columns at once; columns summing to zero yield NaN
+    col_sums = np.sum(R, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centers_of_gravity = np.dot(R.T, label_center) / col_sums[:, np.newaxis]
+    coge = np.linalg.norm(label_center - centers_of_gravity, axis=1)
+    center_of_gravity_list = list(centers_of_gravity)
+    cog_closest_source = list(np.argmin(cdist(centers_of_gravity, label_center), axis=1))
         
-    return 100*np.array(coge), center_of_gravity_list, cog_closest_source
+    return 100*coge, center_of_gravity_list, cog_closest_source
 
 
-def resolution_map(settings, R, res_argument, arg='max', fpath='', print_surf=False):
+def resolution_map(settings, R, res_argument, arg='max', fpath='', print_surf=False, labels=None):
     """Displays and optionally prints a topographic map of cross talk and point spread.
 
     Parameters
@@ -894,6 +1146,10 @@ def resolution_map(settings, R, res_argument, arg='max', fpath='', print_surf=Fa
     print_surf : boolean
         If True, will print a ply file with the resolution maps to the file 
         specified by fpath.
+    labels : list | None
+        Labels corresponding to the rows and columns of R. If given, the value
+        of each label is assigned to all of its vertices before blurring, and
+        vertices outside the labels are filled in by the blurring.
 
     Returns
     -------
@@ -909,9 +1165,18 @@ def resolution_map(settings, R, res_argument, arg='max', fpath='', print_surf=Fa
     if res_argument == 'cross_talk':
         acm = get_average_cross_talk_map(R)
     
+    from mayavi import mlab
     src = mne.read_forward_solution(settings.fname_fwd())['src']
+    if labels is not None:
+        # Map each vertex to its label in one scatter, then gather the label values
+        label_index = _build_label_index(labels, src)
+        vert2label = np.full(src[0]['np'] + src[1]['np'], -1, dtype=int)
+        vert2label[label_index.verts] = np.repeat(np.arange(len(labels)), label_index.sizes)
+        acm_verts = np.where(vert2label >= 0, np.asarray(acm)[vert2label], np.nan)
+    else:
+        acm_verts = acm
     src_joined = join_source_spaces(src)
-    scalars = blurring(acm, src_joined)
+    scalars = blurring(acm_verts, src_joined)
     brain = mlab.triangular_mesh(src_joined['rr'][:, 0], src_joined['rr'][:, 1], src_joined['rr'][:, 2], src_joined['tris'], scalars = scalars)
     if print_surf:
         if len(fpath) == 0:
@@ -960,64 +1225,68 @@ def get_r_master(SNRs, waveform, fname_fwd, labels, inv_methods, labels_unwanted
     -------
     r_master: dictionary
         Dictionary with SNR values as keys and empirical resolution matrices
-        of shape (n_labels, n_labels) as values.
+        of shape (n_labels, n_labels) as values, in single precision.
     r_master_vl: dictionary
         Dictionary with SNR values as keys and empirical resolution matrices
         of shape (n_vertices, n_labels), where vertices have not been grouped
-        into labels, as values.
+        into labels, as values, in single precision.
     """    
-    if  n_jobs < 2*len(SNRs):
-        SNR_njobs = n_jobs
-        activation_jobs = 1
-    else:
-        SNR_njobs = len(SNRs)
-        activation_jobs = np.floor_divide(n_jobs, len(SNRs))
+    # Split activation labels into chunks if there are more jobs than SNRs
+    activation_jobs = max(1, np.floor_divide(n_jobs, len(SNRs)))
     compute_analytical = False
     r_master = {}
     r_master_vl = {}
-    iterations = np.floor_divide(len(SNRs), SNR_njobs)
-    N_remainder = np.mod(len(SNRs), SNR_njobs)
     fwd = mne.read_forward_solution(fname_fwd)
     fwd = mne.convert_forward_solution(fwd, surf_ori=True, force_fixed=True)
     fwd = correct_fwd(fwd, labels_unwanted)
     vertno = fwd['src'][0]['nuse'] + fwd['src'][1]['nuse']
-    
-    SNR_iterations = [SNRs[iteration*SNR_njobs : (iteration + 1) * SNR_njobs] for iteration in range(0, iterations)]
-    if not N_remainder == 0:
-        SNR_iterations.append(SNRs[SNR_njobs*iterations:len(SNRs)])
 
+    # Read noise covariance and background activity once instead of in every task
+    noise_cov = mne.read_cov(cov_fname)
+    epochs_ave = mne.read_evokeds(ave_fname)[0]
+
+    # One Parallel instance for all inverse methods, so that its workers are reused
+    myfunc = delayed(get_R)
+    parallel = Parallel(n_jobs=n_jobs)  # memory maps the gain matrix of fwd for the workers
+
+    # Tensors in single precision, as R in get_R
     for inv_method in inv_methods:
         if activation_labels == None:
-            r_tensor = np.zeros((len(labels), len(labels), len(SNRs)))
-            r_tensor_vl = np.zeros((vertno, len(labels), len(SNRs)))
+            r_tensor = np.zeros((len(labels), len(labels), len(SNRs)), dtype=np.float32)
+            r_tensor_vl = np.zeros((vertno, len(labels), len(SNRs)), dtype=np.float32)
             activation_labels = labels
         else:
-            r_tensor = np.zeros((len(labels), len(activation_labels), len(SNRs)))
-            r_tensor_vl = np.zeros((vertno, len(activation_labels), len(SNRs)))
+            r_tensor = np.zeros((len(labels), len(activation_labels), len(SNRs)), dtype=np.float32)
+            r_tensor_vl = np.zeros((vertno, len(activation_labels), len(SNRs)), dtype=np.float32)
         print('Computing resolution matrices for inverse method ' + inv_method + '...')
-        for group_count, SNR_group in enumerate(SNR_iterations):
-            from joblib import Parallel, delayed
-            myfunc = delayed(get_R)
-            parallel = Parallel(n_jobs=SNR_njobs*activation_jobs)
-            activation_chunks = [list(np.array_split(np.array(activation_labels),activation_jobs)[i]) 
-                                            for i in range(activation_jobs)]
-            inp_group = []
-            for SNR in SNR_group:
-                for k in range(activation_jobs):
-                    inp_group.append((SNR,activation_chunks[k]))
-
-            out = parallel(myfunc((waveform, fname_fwd, labels, inv_method, labels_unwanted,
-                                   inp[0], inp[1], compute_analytical, inv_function, 
-                                   cov_fname, ave_fname)) for inp in inp_group)
-
-            for c, SNR in enumerate(SNR_group):
-                R_emp = np.array([]).reshape(len(labels),0)
-                R_emp_vl = np.array([]).reshape(vertno,0)
-                for d, activation_chunk in enumerate(activation_chunks):
-                    R_emp = np.concatenate((R_emp, out[c*activation_jobs+d][0]), axis=1)
-                    R_emp_vl = np.concatenate((R_emp_vl, out[c*activation_jobs+d][1]), axis=1)
-                r_tensor[:, :, c + group_count*len(SNR_group)] = R_emp
-                r_tensor_vl[:, :, c + group_count*len(SNR_group)] = R_emp_vl
+        # The inverse operator only depends on fwd, noise_cov and info, so it is
+        # made once per method instead of in every (SNR, chunk) task
+        if inv_method in ['MNE', 'dSPM', 'eLORETA', 'sLORETA']:
+            inverse_operator = mne.minimum_norm.make_inverse_operator(epochs_ave.info, fwd, noise_cov, depth=None, fixed=True)
+        else:
+            inverse_operator = None
+        activation_chunks = [list(np.array_split(np.array(activation_labels),activation_jobs)[i]) 
+                                        for i in range(activation_jobs)]
+
+        # One flat task list over all SNRs and activation chunks, scheduled by joblib
+        inp_group = []
+        for SNR in SNRs:
+            for k in range(activation_jobs):
+                inp_group.append((SNR,activation_chunks[k]))
+
+        out = parallel(myfunc((waveform, fwd, labels, inv_method, labels_unwanted,
+                               inp[0], inp[1], compute_analytical, inv_function, 
+                               noise_cov, epochs_ave), inverse_operator=inverse_operator)
+                       for inp in inp_group)
+
+        # Write each chunk into its column slice of the tensors
+        for c, SNR in enumerate(SNRs):
+            col = 0
+            for d, activation_chunk in enumerate(activation_chunks):
+                n_cols = len(activation_chunk)
+                r_tensor[:, col:col+n_cols, c] = out[c*activation_jobs+d][0]
+                r_tensor_vl[:, col:col+n_cols, c] = out[c*activation_jobs+d][1]
+                col += n_cols
         r_master.update({inv_method : r_tensor})
         r_master_vl.update({inv_method : r_tensor_vl})
     
@@ -1026,7 +1295,7 @@ def get_r_master(SNRs, waveform, fname_fwd, labels, inv_methods, labels_unwanted
     return r_master, r_master_vl
 
 
-def get_roc_statistics(r_master, inv_methods):
+def get_roc_statistics(r_master, inv_methods, n_jobs=1):
     """Gets ROC statistics from r_master object.
 
     Parameters
@@ -1035,6 +1304,8 @@ def get_roc_statistics(r_master, inv_methods):
         r_master object, of the type returned by get_r_master function.
     inv_methods : list
         List of strings of inverse methods to calculate ROC for.
+    n_jobs : int
+        Number of jobs to run in parallel over inverse methods and SNRs.
 
     Returns
     -------
@@ -1042,25 +1313,22 @@ def get_roc_statistics(r_master, inv_methods):
         Dictionary containing ROC stats roc, auc and all_stats.
     """
     roc_stats = {'roc' : {}, 'acu' : {}, 'all_stats' : {}}
+    n_SNRs = len(list(r_master['SNRs']))
+
+    # The curves of all inverse methods and SNRs are independent
+    out = Parallel(n_jobs=n_jobs)(delayed(get_roc)(r_master[inv_method][:,:,c])
+                                  for inv_method in inv_methods for c in range(n_SNRs))
     
-    for inv_method in inv_methods:
-        R_tensor = r_master[inv_method]
-        roc_list = {'roc' : [], 'acu' : [], 'all_stats' : []}
-        
-        for c,SNR in enumerate(list(r_master['SNRs'])):
-            roc, acu, all_stats = get_roc(R_tensor[:,:,c])
-            roc_list['roc'].append(roc)
-            roc_list['acu'].append(acu)
-            roc_list['all_stats'].append(all_stats)            
-            
-        roc_stats['roc'].update({inv_method : roc_list['roc']})
-        roc_stats['acu'].update({inv_method : roc_list['acu']})
-        roc_stats['all_stats'].update({inv_method : roc_list['all_stats']})
+    for m, inv_method in enumerate(inv_methods):
+        roc_list = out[m*n_SNRs:(m+1)*n_SNRs]
+        roc_stats['roc'].update({inv_method : [roc for roc, acu, all_stats in roc_list]})
+        roc_stats['acu'].update({inv_method : [acu for roc, acu, all_stats in roc_list]})
+        roc_stats['all_stats'].update({inv_method : [all_stats for roc, acu, all_stats in roc_list]})
         
     return roc_stats
 
 
-def get_prc_statistics(r_master, inv_methods):
+def get_prc_statistics(r_master, inv_methods, n_jobs=1):
     """Gets PRC statistics from r_master object.
 
     Parameters
@@ -1069,6 +1337,8 @@ def get_prc_statistics(r_master, inv_methods):
         r_master object, of the type returned by get_r_master function.
     inv_methods : list
         List of strings of inverse methods to calculate ROC for.
+    n_jobs : int
+        Number of jobs to run in parallel over inverse methods and SNRs.
 
     Returns
     -------
@@ -1076,29 +1346,194 @@ def get_prc_statistics(r_master, inv_methods):
         Dictionary containing PRC stats prc, auc and all_stats.
     """
     prc_stats = {'prc' : {}, 'acu' : {}, 'all_stats' : {}}
+    n_SNRs = len(list(r_master['SNRs']))
+
+    # The curves of all inverse methods and SNRs are independent
+    out = Parallel(n_jobs=n_jobs)(delayed(get_prc)(r_master[inv_method][:,:,c])
+                                  for inv_method in inv_methods for c in range(n_SNRs))
     
-    for inv_method in inv_methods:
-        R_tensor = r_master[inv_method]
-        prc_list = {'prc' : [], 'acu' : [], 'all_stats' : []}
-        
-        for c,SNR in enumerate(list(r_master['SNRs'])):
-            prc, acu = get_prc(R_tensor[:,:,c])
-            prc_list['prc'].append(prc)
-            prc_list['acu'].append(acu)
-            
-        prc_stats['prc'].update({inv_method : prc_list['prc']})
-        prc_stats['acu'].update({inv_method : prc_list['acu']})
+    for m, inv_method in enumerate(inv_methods):
+        prc_list = out[m*n_SNRs:(m+1)*n_SNRs]
+        prc_stats['prc'].update({inv_method : [prc for prc, acu in prc_list]})
+        prc_stats['acu'].update({inv_method : [acu for prc, acu in prc_list]})
         
     return prc_stats
 
 
-def get_roc(R):
+def get_roc_prc_statistics(r_master, inv_methods, n_jobs=1):
+    """Gets ROC and PRC statistics from r_master object. Equivalent to calling
+    get_roc_statistics and get_prc_statistics, but standardizes and sorts each
+    resolution matrix only once for both curves.
+
+    Parameters
+    ----------
+    r_master : dictionary
+        r_master object, of the type returned by get_r_master function.
+    inv_methods : list
+        List of strings of inverse methods to calculate ROC and PRC for.
+    n_jobs : int
+        Number of jobs to run in parallel over inverse methods and SNRs.
+
+    Returns
+    -------
+    roc_stats : dictionary
+        Dictionary containing ROC stats roc, auc and all_stats.
+    prc_stats : dictionary
+        Dictionary containing PRC stats prc, auc and all_stats.
+    """
+    roc_stats = {'roc' : {}, 'acu' : {}, 'all_stats' : {}}
+    prc_stats = {'prc' : {}, 'acu' : {}, 'all_stats' : {}}
+    n_SNRs = len(list(r_master['SNRs']))
+
+    out = Parallel(n_jobs=n_jobs)(delayed(_get_roc_prc)(r_master[inv_method][:,:,c])
+                                  for inv_method in inv_methods for c in range(n_SNRs))
+
+    for m, inv_method in enumerate(inv_methods):
+        curves = out[m*n_SNRs:(m+1)*n_SNRs]
+        roc_stats['roc'].update({inv_method : [roc[0] for roc, prc in curves]})
+        roc_stats['acu'].update({inv_method : [roc[1] for roc, prc in curves]})
+        roc_stats['all_stats'].update({inv_method : [roc[2] for roc, prc in curves]})
+        prc_stats['prc'].update({inv_method : [prc[0] for roc, prc in curves]})
+        prc_stats['acu'].update({inv_method : [prc[1] for roc, prc in curves]})
+
+    return roc_stats, prc_stats
+
+
+def _get_roc_prc(R):
+    """Returns the outputs of get_roc and get_prc, sharing the preprocessing."""
+    curve_data = _curve_preproc(R)
+    aucs = _get_exact_auc(curve_data)
+    return get_roc(R, curve_data, aucs), get_prc(R, curve_data, aucs)
+
+
+if _has_numba:
+    @njit(cache=True, error_model='numpy')
+    def _curve_preproc_numba(R):
+        """Numba kernel of standardize_columns(R, 'max') followed by taking the
+        diagonal and remove_diagonal, in one traversal of each column. A NaN
+        in a column gives a NaN maximum, as with np.max."""
+        n = R.shape[0]
+        true_estimates = np.empty(n, dtype=R.dtype)
+        off_diagonals = np.empty(n*n - n, dtype=R.dtype)
+        k = 0
+        for j in range(n):
+            col_max = R[0, j]
+            for i in range(1, n):
+                v = R[i, j]
+                if np.isnan(v):
+                    col_max = v
+                    break
+                if v > col_max:
+                    col_max = v
+            for i in range(n):
+                v = R[i, j] / col_max
+                if i == j:
+                    true_estimates[j] = v
+                else:
+                    off_diagonals[k] = v
+                    k += 1
+        return true_estimates, off_diagonals
+
+
+def _curve_preproc(R):
+    """Standardizes R with respect to the maximum of each column and returns
+    the sorted estimates that the ROC and PRC curves are computed from. NaN 
+    estimates are dropped, so that they count as neither positive nor negative,
+    as in an elementwise comparison.
+
+    Parameters
+    ----------
+    R : array, shape (n_sources, n_sources)
+        Resolution matrix.
+
+    Returns
+    -------
+    curve_data : tuple
+        Sorted estimates of the activated sources (the diagonal of R), sorted
+        estimates of the non-activated sources (the off-diagonal of R) and the
+        number of activated sources.
+    """
+    if _has_numba and R.shape[0] == R.shape[1]:
+        true_estimates, off_diagonals = _curve_preproc_numba(R)
+    else:
+        R_max = standardize_columns(R, arg='max')
+        true_estimates = np.diag(R_max)
+        off_diagonals = remove_diagonal(R_max)
+    true_sorted = np.sort(true_estimates[~np.isnan(true_estimates)], axis=None)
+    off_sorted = np.sort(off_diagonals[~np.isnan(off_diagonals)], axis=None)
+    return true_sorted, off_sorted, true_estimates.size
+
+
+def _threshold_counts(curve_data, thresholds):
+    """Counts true positives, false negatives, true negatives and false 
+    positives for all thresholds with binary searches in the sorted estimates
+    instead of scanning the estimates once per threshold.
+
+    Parameters
+    ----------
+    curve_data : tuple
+        Sorted estimates, as returned by _curve_preproc.
+    thresholds : array
+        Threshold values.
+
+    Returns
+    -------
+    TP, FN, TN, FP : arrays, shape (n_thresholds)
+        Counts for each threshold.
+    """
+    true_sorted, off_sorted, n_true = curve_data
+    TP = len(true_sorted) - np.searchsorted(true_sorted, thresholds, side='right')
+    FN = n_true - TP
+    TN = np.searchsorted(off_sorted, thresholds, side='right')
+    FP = len(off_sorted) - np.searchsorted(off_sorted, thresholds, side='left')
+    return TP, FN, TN, FP
+
+
+def _get_exact_auc(curve_data):
+    """Computes the areas under the ROC and PRC curves exactly from the sorted
+    estimates, instead of by quadrature over a grid of thresholds.
+
+    Parameters
+    ----------
+    curve_data : tuple
+        Sorted estimates, as returned by _curve_preproc.
+
+    Returns
+    -------
+    roc_auc : float
+        Area under the ROC curve, i.e. the probability that an activated
+        source has a higher estimate than a non-activated one, counting ties 
+        as one half.
+    prc_auc : float
+        Average precision, i.e. the precision at each distinct estimate of the
+        activated sources weighted by the corresponding increase in recall.
+    """
+    true_sorted, off_sorted, n_true = curve_data
+    n_off = len(off_sorted)
+    below = np.searchsorted(off_sorted, true_sorted, side='left')
+    ties = np.searchsorted(off_sorted, true_sorted, side='right') - below
+    thresholds = np.unique(true_sorted)[::-1]
+    TP = len(true_sorted) - np.searchsorted(true_sorted, thresholds, side='left')
+    FP = n_off - np.searchsorted(off_sorted, thresholds, side='left')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roc_auc = (np.sum(below) + 0.5*np.sum(ties)) / (n_true*n_off)
+        prc_auc = np.sum(np.diff(np.concatenate(([0], TP))) / n_true * TP/(TP+FP))
+    return roc_auc, prc_auc
+
+
+def get_roc(R, curve_data=None, aucs=None):
     """Calculates ROC curve from resolution matrix R.
 
     Parameters
     ----------
     R : array, shape (n_sources, n_sources)
         Resolution matrix.
+    curve_data : tuple | None
+        Preprocessed estimates of R (see _curve_preproc). Computed from R if
+        None.
+    aucs : tuple | None
+        Areas under the ROC and PRC curves of curve_data (see _get_exact_auc).
+        Computed from curve_data if None.
 
     Returns
     -------
@@ -1107,7 +1542,8 @@ def get_roc(R):
         The threshold value will vary from -0.01 to 1.01 with n_T as the number
         of points in between (can be an arbitrary value).
     acu : float
-        Area under the ROC curve. Will be between 0 and 1.
+        Area under the ROC curve. Will be between 0 and 1. Computed exactly
+        from the estimates rather than from the n_T points of ROC.
     all_stats : dictionary
         Dictionary with True positives, False negatives, True negatives and 
         False positives as keys and their respective values for each threshold 
@@ -1115,34 +1551,21 @@ def get_roc(R):
     """
     n_T = 100
     ROC = np.zeros((2,n_T+3))    
-    R_max = standardize_columns(R, arg='max')
-    true_estimates = np.diag(R_max)
-    R_max_off_diagonals = remove_diagonal(R_max)
-    acu = []
-    all_stats = {'TP' : [], 'FN' : [], 'TN' : [], 'FP' : []}
-
-    for c,T in enumerate(np.linspace(-0.01,1.01,n_T)):
-        TP = np.sum(true_estimates > T)
-        FN = len(true_estimates) - TP
-        TN = np.sum(R_max_off_diagonals <= T)
-        FP = np.sum(R_max_off_diagonals >= T)
-        TPR = TP/(TP+FN)
-        FPR = FP/(FP+TN)
-        ROC[0,c] = FPR
-        ROC[1,c] = TPR
-        all_stats['TP'].append(TP)
-        all_stats['FN'].append(FN)
-        all_stats['TN'].append(TN)
-        all_stats['FP'].append(FP)
-
-    for stats in list(all_stats.keys()):
-        all_stats[stats] = np.array(all_stats[stats])
+    if curve_data is None:
+        curve_data = _curve_preproc(R)
+
+    TP, FN, TN, FP = _threshold_counts(curve_data, np.linspace(-0.01,1.01,n_T))
+    ROC[0,:n_T] = FP/(FP+TN)
+    ROC[1,:n_T] = TP/(TP+FN)
+    all_stats = {'TP' : TP, 'FN' : FN, 'TN' : TN, 'FP' : FP}
     
-    acu = np.abs(np.trapz(y=ROC[1,:], x=ROC[0,:], dx=0.001))
+    if aucs is None:
+        aucs = _get_exact_auc(curve_data)
+    acu = aucs[0]
     return ROC, acu, all_stats
 
 
-def get_prc(R):
+def get_prc(R, curve_data=None, aucs=None):
     """Calculates precision-recall curve from resolution matrix R.
     Y-axis: PPV = TP/(TP+FP)
     X-axis: TPR = TP/(TP+FN)
@@ -1151,6 +1574,12 @@ def get_prc(R):
     ----------
     R : array, shape (n_sources, n_sources)
         Resolution matrix.
+    curve_data : tuple | None
+        Preprocessed estimates of R (see _curve_preproc). Computed from R if
+        None.
+    aucs : tuple | None
+        Areas under the ROC and PRC curves of curve_data (see _get_exact_auc).
+        Computed from curve_data if None.
 
     Returns
     -------
@@ -1159,30 +1588,28 @@ def get_prc(R):
         The threshold value will vary from -0.01 to 1.01 with n_T as the number
         of points in between (can be an arbitrary value).
     acu : float
-        Area under the ROC curve. Will be between 0 and 1.
+        Area under the PRC curve (average precision). Will be between 0 and 1.
+        Computed exactly from the estimates rather than from the n_T points
+        of PRC.
     """
     n_T = 1000
     PRC = np.zeros((2,n_T))#np.zeros((2,n_T+3))    
-    R_max = standardize_columns(R, arg='max')
-    true_estimates = np.diag(R_max)
-    R_max_off_diagonals = remove_diagonal(R_max)
-    acu = []
-
-    for c,T in enumerate(np.linspace(-0.001,1.001,n_T)):
-        TP = np.sum(true_estimates > T)
-        FN = len(true_estimates) - TP
-        TN = np.sum(R_max_off_diagonals <= T)
-        FP = np.sum(R_max_off_diagonals >= T)
-        PPV = TP/(TP+FP)
-        TPR = TP/(TP+FN)
-        if np.isnan(PPV):
-            print('NaN encountered for threshold T='+str(T)+', using previous T for setting PPV value')
-            PPV = PRC[1,c-1]
-        PRC[0,c] = TPR
-        PRC[1,c] = PPV
+    if curve_data is None:
+        curve_data = _curve_preproc(R)
+
+    thresholds = np.linspace(-0.001,1.001,n_T)
+    TP, FN, TN, FP = _threshold_counts(curve_data, thresholds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        PRC[1,:] = TP/(TP+FP)
+    PRC[0,:] = TP/(TP+FN)
+    for c in np.where(np.isnan(PRC[1,:]))[0]:
+        print('NaN encountered for threshold T='+str(thresholds[c])+', using previous T for setting PPV value')
+        PRC[1,c] = PRC[1,c-1]
             
 
-    acu = np.abs(np.trapz(y=PRC[1,:], x=PRC[0,:], dx=0.001))
+    if aucs is None:
+        aucs = _get_exact_auc(curve_data)
+    acu = aucs[1]
     return PRC, acu
 
 
@@ -1200,11 +1627,7 @@ def count_sources_in_labels(labels, fwd):
     vert_nrs : array, shape (n_labels)
         Number of active sources in each label.
     """
-    vert_nrs = []
-    for label in labels: 
-        if label.hemi == 'lh': 
-            vert_nrs.append(np.sum(np.isin(label.vertices, fwd['src'][0]['vertno']))) 
-        if label.hemi == 'rh': 
-            vert_nrs.append(np.sum(np.isin(label.vertices, fwd['src'][1]['vertno']))) 
-    return np.array(vert_nrs)
+    label_index = _build_label_index(labels, fwd['src'])
+    vert_nrs = label_index.M.dot(_get_source_mask(fwd['src'])).astype(int)
+    return vert_nrs
 
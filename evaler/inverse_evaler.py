@@ -104,8 +104,7 @@ def get_empirical_R(data_path, subjects, inv_methods, SNRs, waveform, inv_functi
         r_m, r_mpp = evaler.get_r_master(SNRs, waveform, fname_fwd, labels, inv_methods, labels_unwanted,
                                          data_path+subject+'/'+subject+'-cov.fif', data_path+subject+'/'+subject+'-ave.fif',
                                          labels, inv_function, n_jobs)
-        roc_stats = evaler.get_roc_statistics(r_m, inv_methods)
-        prc_stats = evaler.get_prc_statistics(r_m, inv_methods)
+        roc_stats, prc_stats = evaler.get_roc_prc_statistics(r_m, inv_methods, n_jobs)
         R_emp.update({subject : {'r_master' : r_m, 
                                  'r_master_point_patch' : r_mpp, 
                                  'roc_stats' : roc_stats,
@@ -131,10 +130,9 @@ def get_average_R(R_emp):
     SNRs = R_emp[list(R_emp.keys())[0]]['r_master']['SNRs']
     r_master = {'SNRs' : SNRs}
     for method in inv_methods:
-        r_master_subject = np.array([]).reshape(1000,1000,len(SNRs),0)
-        for subject in list(R_emp.keys()):
-            r_master_subject = np.concatenate((r_master_subject, R_emp[subject]['r_master'][method].reshape(1000,1000,len(SNRs),1)/
-                                               np.sum(R_emp[subject]['r_master'][method])), axis=3)
+        # Collect the normalized subject tensors and stack them once
+        r_master_subject = np.stack([R_emp[subject]['r_master'][method]/np.sum(R_emp[subject]['r_master'][method])
+                                     for subject in list(R_emp.keys())], axis=3)
         r_master.update({method : np.mean(r_master_subject, axis=3)})
     return r_master
 
@@ -208,11 +206,8 @@ def get_classifier_curve_stats(R_emp, curve='roc_stats'):
         methods_dir = {}
         methods_dir_subjects = {}
         for method in inv_methods:
-            r_master_subject = np.array([]).reshape(np.array(R_emp[subjects[0]][curve][metrics][method]).shape+(0,))
-            for subject in list(R_emp.keys()):
-                r_master_subject = np.concatenate((r_master_subject, np.array(R_emp[subject][curve][metrics][method]). \
-                                                   reshape(np.array(R_emp[subject][curve][metrics][method]).shape+(1,))), \
-                                                   axis=len(r_master_subject.shape)-1)
+            r_master_subject = np.stack([np.array(R_emp[subject][curve][metrics][method]) 
+                                         for subject in list(R_emp.keys())], axis=-1)
             scals = np.array([np.nanmin(r_master_subject, axis=len(r_master_subject.shape)-1), 
                               np.nanmean(r_master_subject, axis=len(r_master_subject.shape)-1), 
                               np.nanmax(r_master_subject, axis=len(r_master_subject.shape)-1)])
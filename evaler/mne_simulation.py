@@ -172,8 +172,8 @@ def simulate_activation(t_noise, t_event, labels, verts, settings, dipole_wavefo
 
     #Check that the number of dipole wave forms is the same as the number of vertices or labels  
     if dipole_waveforms == 'oscillation':
-        dipole_waveforms = np.zeros((n,len(t)))
-        dipole_waveforms = oscillation(t=np.repeat(t.reshape(1,len(t)),repeats=n,axis=0))
+        # Same oscillation for all n vertex groups; evaluate it once and tile the rows
+        dipole_waveforms = np.tile(oscillation(t=t), (n, 1))
         
     if dipole_waveforms.shape[0] != len(verts):
         raise Exception('dipole_waveforms must be of the same size as verts')
@@ -183,17 +183,16 @@ def simulate_activation(t_noise, t_event, labels, verts, settings, dipole_wavefo
     fwd = mne.convert_forward_solution(fwd,surf_ori=True,force_fixed=True)
     
     #Find vertices that are active in forward model. If none, take closest vertex.
-    wave_forms = np.array([]).reshape(0,dipole_waveforms.shape[1])
+    #All vertices of a group share its waveform, so sum their gain instead of repeating the waveform per vertex
+    G_group = np.zeros((fwd['sol']['data'].shape[0],len(verts)))
     active_verts = np.array([])
     for c,vertex_group in enumerate(verts):
         if len(vertex_group) == 1:
             verts_in_fwd = np.array([np.argmin(np.abs(fwd['src'][0]['vertno']-vertex_group[0]))])
-            wave_forms = dipole_waveforms
         else:
             in_fwd = vertex_group[np.isin(vertex_group,fwd['src'][0]['vertno'])]
-            verts_in_fwd = np.array([np.argmin(np.abs(fwd['src'][0]['vertno']-vert)) for vert in in_fwd])
-            temp = np.repeat(dipole_waveforms[c,:].reshape(1,len(dipole_waveforms[c,:])),repeats=len(verts_in_fwd),axis=0)
-            wave_forms = np.concatenate((wave_forms,temp),axis=0)
+            verts_in_fwd = np.array([np.argmin(np.abs(fwd['src'][0]['vertno']-vert)) for vert in in_fwd]).astype(int)
+        G_group[:,c] = np.sum(fwd['sol']['data'][:,verts_in_fwd],axis=1)
             
         active_verts = np.concatenate((active_verts,verts_in_fwd),axis=0).astype(int)
         
@@ -206,7 +205,7 @@ def simulate_activation(t_noise, t_event, labels, verts, settings, dipole_wavefo
     noise = get_noise(raw, events, t_noise, n_t, n_epochs)
     
     #Simulate signal
-    signal = forward_operation(fwd = fwd, f=wave_forms, t=t, verts = active_verts, fs = fs)    
+    signal = np.dot(G_group,dipole_waveforms)
     if len(dipole_waveforms.shape) == 1:
         t = t.reshape(1,len(t))
         t = np.repeat(t,n,axis=0)
@@ -48,10 +48,11 @@ def fill_empty_labels(src, labels):
     for c, hemi in enumerate(['lh', 'rh']):
         verts_to_add = []
         labels_hemi = labels_divide[c]
+        # Boolean mask of vertices in use, so that membership is a gather instead of a search in vertno
+        is_source = np.zeros(src[c]['np'], dtype=bool)
+        is_source[src[c]['vertno']] = True
         for label in labels_hemi:
-            label_verts = label[1].vertices
-            sources_in_label = np.array([vert for vert in label[1].vertices if vert in src[c]['vertno']])
-            if len(sources_in_label) == 0:
+            if not np.any(is_source[label[1].vertices]):
                 verts_to_add.append(label[1].vertices[0])
                 zero_labels.append(label)
         verts_to_add_hemi.append(verts_to_add)
@@ -446,17 +447,16 @@ def remove_cortical_labels(all_labels):
 def remove_overlap_in_labels(settings, labels, vertlim=20):
     from collections import Counter
     labels_org = [label.copy() for label in labels]
-    verts_tot_lh = np.array([]).reshape(1,0) 
-    verts_tot_rh = np.array([]).reshape(1,0) 
+    verts_tot_lh = [np.array([], dtype=int)]
+    verts_tot_rh = [np.array([], dtype=int)]
     for label in labels:
-        verts=label.vertices 
         if label.hemi == 'lh': 
-            verts_tot_lh=np.hstack((verts_tot_lh,verts.reshape(1,len(verts)))) 
+            verts_tot_lh.append(label.vertices)
         if label.hemi == 'rh': 
-            verts_tot_rh=np.hstack((verts_tot_rh,verts.reshape(1,len(verts)))) 
+            verts_tot_rh.append(label.vertices)
             
-    verts_tot_rh = verts_tot_rh.flatten()
-    verts_tot_lh = verts_tot_lh.flatten()
+    verts_tot_rh = np.concatenate(verts_tot_rh)
+    verts_tot_lh = np.concatenate(verts_tot_lh)
     overlapping_vertices = len(verts_tot_rh) - len(np.unique(verts_tot_rh)) + \
                                 len(verts_tot_lh) - len(np.unique(verts_tot_lh))
     print(str(overlapping_vertices) + ' overlapping vertices found, removing...')
@@ -487,17 +487,18 @@ def remove_overlap_in_labels(settings, labels, vertlim=20):
                     break
                 
     #check that vertices are no longer overlapping and cover entirety of cortex
-    a = np.array([]).reshape(1,0)
+    a = [np.array([], dtype=int)]
     fwd = mne.read_forward_solution(settings.fname_fwd())
     offset = fwd['src'][0]['np']
     for label in disjoint_labels:
         if label.hemi == 'lh':
-            a = np.concatenate((a,label.vertices.reshape(1,len(label.vertices))),axis=1)
+            a.append(label.vertices)
         if label.hemi == 'rh':
-            a = np.concatenate((a,label.vertices.reshape(1,len(label.vertices))+offset),axis=1)
-    if a.shape[1] == np.unique(a).shape[0]:
+            a.append(label.vertices+offset)
+    a = np.concatenate(a)
+    if a.shape[0] == np.unique(a).shape[0]:
         print('Labels are now non-overlapping.')
-        if a.shape[1] == fwd['src'][0]['np']+fwd['src'][1]['np']:
+        if a.shape[0] == fwd['src'][0]['np']+fwd['src'][1]['np']:
             print('Labels cover entirety of cortex.')
         else:
             warnings.warn('Labels are not covering entirety of cortex.')